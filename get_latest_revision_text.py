@@ -4,27 +4,35 @@ Wikipedia articles, without needing to parse the Wikitext or perform
 any cleaning (the extracts API does it for us).
 
 It will batch up to 20 articles per request, always respecting the API's
-limits.
+limits, and send the batches concurrently over a shared connection pool.
 """
 
 import requests
-from typing import List
+import itertools
+from concurrent.futures import ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from typing import Dict, List
 
 N_ARTICLES_PER_REQUEST = 20  # extracts API's limit
+N_PARALLEL_REQUESTS = 2  # Kept low to stay within the API's limits
 USER_AGENT = "My Wikipedia API project (change me!)"
 
+# Reused across requests so that connections (and their TLS handshakes) are kept alive,
+# retrying rate limited or failed requests instead of losing their articles
+_SESSION = requests.Session()
+_SESSION.headers.update({"User-Agent": USER_AGENT})
+_SESSION.mount("https://", HTTPAdapter(pool_connections=N_PARALLEL_REQUESTS, pool_maxsize=2 * N_PARALLEL_REQUESTS,
+                                       max_retries=Retry(total=5, backoff_factor=0.3, status_forcelist=[429, 503])))
 
-def get_latest_revisions(lang: str, titles: List[str], only_intro=False):
+
+def _fetch_chunk(lang: str, titles: List[str], only_intro=False) -> Dict[str, str]:
     """
-    Returns a dict of article title -> text given the provided
-    list of titles for the language of choice
+    Returns a dict of article title -> text for up to
+    N_ARTICLES_PER_REQUEST titles, in a single request
     """
     base_url = f"https://{lang}.wikipedia.org/w/api.php"
 
-    headers = {
-        "User-Agent": USER_AGENT
-    }
-
     # Wikipedia already has a extract API functionality for returning raw text (not wikitext formatted),
     # so we don't need to use mwparserfromhell for wikitext or beautifulsoup for html
     # https://www.mediawiki.org/wiki/Extension:TextExtracts#API
@@ -38,11 +46,16 @@ def get_latest_revisions(lang: str, titles: List[str], only_intro=False):
         "exlimit": N_ARTICLES_PER_REQUEST,
     }
 
-    response = requests.get(base_url, headers=headers, params=params)
+    response = _SESSION.get(base_url, params=params)
     response_json = response.json()
 
     # Find the page_id
     article_texts = dict()
+    if "query" not in response_json:
+        # Don't take the other chunks down with this one
+        print(f"Failed request for {titles}, response:", response_json)
+        return article_texts
+
     for page_id, inner_dict in response_json["query"]["pages"].items():
         # The API normalizes titles (removes '_' characters, etc.), so we have
         # to look up the original article title
@@ -61,6 +74,22 @@ def get_latest_revisions(lang: str, titles: List[str], only_intro=False):
     return article_texts
 
 
+def get_latest_revisions(lang: str, titles: List[str], only_intro=False) -> Dict[str, str]:
+    """
+    Returns a dict of article title -> text given the provided
+    list of titles for the language of choice
+    """
+    titles_iter = iter(titles)
+    chunks = list(iter(lambda: list(itertools.islice(titles_iter, N_ARTICLES_PER_REQUEST)), []))
+
+    article_texts = dict()
+    with ThreadPoolExecutor(max_workers=N_PARALLEL_REQUESTS) as executor:
+        for chunk_texts in executor.map(lambda chunk: _fetch_chunk(lang, chunk, only_intro), chunks):
+            article_texts.update(chunk_texts)
+
+    return article_texts
+
+
 if __name__ == "__main__":
     # List of Wikipedia page titles we want to extract
     # (you can obtain them manually or via e.g Wikidata SPARQL queries)
@@ -7,7 +7,7 @@ of revisions, so this may take up to half an hour for the biggest articles (e.g
 Trump in the English Wikipedia).
 
 Multiprocessing is used extensively, and the parsing and cleaning step is performed
-after having downloaded all revisions
+while the next pages of revisions are being downloaded
 
 The result will be a json file containing a list of dictionaries with "timestamp"
 and "content" keys, with its entries ordered from older to newer revisions
@@ -19,148 +19,412 @@ does this in a much better way, as the 'extracts' API does the text processing f
 import requests
 import json
 import re
-import ijson
 import itertools
+import contextlib
+import functools
+import hashlib
+import collections
+import multiprocessing
 from datetime import datetime
 from concurrent.futures import ProcessPoolExecutor
 
 import mwparserfromhell
-from nltk.tokenize import WhitespaceTokenizer
+
+# Shared with get_revision_history_for_wikievent.py
+from wiki_api import USER_AGENT, MAX_PENDING_PAGES, make_session, prefetch
+
+try:
+    # Optional, much faster than the json module for big revisions
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    # Optional, only needed for cleaning revisions rendered by the parse API
+    import lxml.html
+except ImportError:
+    lxml = None
 
 
 # How many text cleaning workers to spawn (up to your CPU's #threads)
 N_WORKERS = 4
-USER_AGENT = "My Wikipedia API project (change me!)"
+
+# How many revisions are read from the revisions file and handed to the workers
+# at once, the same as an API page
+CHUNK_SIZE = 1000
+# How many pieces each worker's share of a chunk is split into when sending it to
+# the workers. Fewer pieces mean less IPC, more of them help balance the load, as
+# revisions can be very different in size
+N_TASKS_PER_WORKER = 4
+# How many cleaned revisions to remember, so that revisions with the same content
+# as a recent one (reverts of vandalism, null edits...) aren't parsed and cleaned
+# again, nor even sent to the workers
+CLEAN_CACHE_SIZE = 4096
+
+# Workers are spawned rather than forked, as forking while the downloader thread
+# (or a session's connections) is alive can deadlock the child processes
+_WORKERS_CONTEXT = multiprocessing.get_context("spawn")
+
+# Session used by each worker process for parse API requests, created on first use
+_parse_session = None
+
+# Elements of the parse API's HTML that aren't part of the article's prose: inline
+# stylesheets and scripts from templates, citation markers (e.g "[12]"), reference
+# lists with their backlinks, hatnotes ("For other uses, see...") and navboxes
+_HAS_CLASS = "contains(concat(' ', normalize-space(@class), ' '), ' {} ')"
+_NON_PROSE_XPATH = '|'.join([
+    '//style', '//script',
+    f'//sup[{_HAS_CLASS.format("reference")}]',
+    f'//ol[{_HAS_CLASS.format("references")}]',
+    f'//*[{_HAS_CLASS.format("mw-references-wrap")}]',
+    f'//*[{_HAS_CLASS.format("mw-cite-backlink")}]',
+    f'//*[{_HAS_CLASS.format("hatnote")}]',
+    f'//*[{_HAS_CLASS.format("navbox")}]',
+])
+
+# Compiled once at import (i.e once per worker process) instead of once per revision.
+# Matches citations (e.g "[12]") and whitespace-delimited numbers in a single pass.
+# \d rather than [0-9], so that numbers in other scripts (e.g "१९४७") are removed too.
+# Unlike the old isnumeric() filter, tokens made of numeric characters that aren't
+# decimal digits (e.g "½", "²", "Ⅻ", "五", "2½") are kept: a character class covering
+# all of them makes this pass about 10x slower
+# The engine still tries a match at every position, but both alternatives now start
+# with a single character test ('[' or a digit) that fails right away on most of them.
+# The "preceded by whitespace" lookbehind is only checked after a digit, instead of
+# at every position as it was when it came first
+_CLEANUP_RE = re.compile(r'\[\d+\]|\d(?<!\S\d)\d*(?!\S)')
+# These section names are standard, so it should remove them
+# everywhere except in small or unpopular articles that may
+# not be well taken care of
+_SECTION_MARKERS = ("Notes\n", "External links\n", "References\n")
 
 
 def clean_doc(doc):
-    # Remove sections from the article that may cause confusions
-    def remove_everything_after(doc, substr):
-        substr_idx = doc.find(substr)
-        if substr_idx != -1:
-            return 1, doc[:substr_idx]
+    # Remove sections from the article that may cause confusions, cutting
+    # at whichever of them appears first. Each search is bounded by the
+    # earliest cut found so far, and the document is only sliced once
+    cut_idx = len(doc)
+    for marker in _SECTION_MARKERS:
+        marker_idx = doc.find(marker, 0, cut_idx)
+        if marker_idx != -1:
+            cut_idx = marker_idx
+    doc = doc[:cut_idx]
+
+    # Remove numbers and any citations that may have gotten through,
+    # but keep everything else
+    doc = _CLEANUP_RE.sub('', doc)
+
+    # Words are kept separated by a single space, as before
+    doc = " ".join(doc.split())
 
-        return 0, doc
+    return doc
 
-    # These section names are standard, so it should remove them
-    # everywhere except in small or unpopular articles that may
-    # not be well taken care of
-    removed_notes, doc = remove_everything_after(doc, "Notes\n")
-    removed_links, doc = remove_everything_after(doc, "External links\n")
-    removed_refs, doc = remove_everything_after(doc, "References\n")
 
-    # We want to reconstruct the document afterwards, so we use the simplest
-    # tokenizer possible
-    tokens = WhitespaceTokenizer().tokenize(doc)
+def dump_json(obj, indent):
+    if orjson is not None:
+        return orjson.dumps(obj, option=orjson.OPT_INDENT_2 if indent else 0).decode('utf-8')
 
-    # Remove numbers, but keep everything else
-    doc = " ".join([token for token in tokens if not token.isnumeric()])
+    return json.dumps(obj, ensure_ascii=False, indent=2 if indent else None)
 
-    # Also remove any citations that may have gotten through
-    citation_regex = r'\[[0-9]+\]'
-    doc = re.sub(citation_regex, '', doc)
 
-    return doc
+def load_json(line):
+    if orjson is not None:
+        return orjson.loads(line)
+
+    return json.loads(line)
+
+
+def write_revision_lines(f, revisions_data):
+    """
+    Appends revision dicts to an open JSON Lines file, one per line
+    """
+    f.write("".join(dump_json(revision_entry, indent=False) + "\n" for revision_entry in revisions_data))
+
+
+def read_revision_lines(f):
+    """
+    Yields the revision dicts of an open (binary) JSON Lines file, one at a time.
+    An interrupted download may have left its last line cut off at any byte, so
+    an undecodable last line is skipped instead of failing
+    """
+    for line in f:
+        if line.isspace():
+            continue
 
+        try:
+            revision_entry = load_json(line)
+        except ValueError:
+            # Only the last line can lack its newline
+            if line.endswith(b"\n"):
+                raise
+            print("Skipping the truncated last line of the revisions file")
+            return
 
-def write_revisions(f, revisions_data):
-    for i, revision in enumerate(revisions_data):
-        timestamp = revision['timestamp']
-        text = revision['content']
-        # Convert the API's custom timestamp to a unix one for better portability
-        dt_object = datetime.strptime(timestamp, "%Y-%m-%dT%H:%M:%SZ")
-        unix_timestamp = int(dt_object.timestamp())
+        yield revision_entry
 
-        revision_entry = {'timestamp': unix_timestamp, 'content': text}
 
-        json.dump(revision_entry, f, ensure_ascii=False, indent=4)
-        if i < (len(revisions_data) - 1):
+def write_revisions(f, revisions_data, first_entry):
+    """
+    Streams a list of revision dicts into an open JSON list, returning
+    whether the next entry will still be the first one
+    """
+    for revision_entry in revisions_data:
+        if not first_entry:
             f.write(",\n")
+        f.write(dump_json(revision_entry, indent=True))
+        first_entry = False
+
+    return first_entry
+
+
+def fetch_revisions(lang, article_title):
+    """
+    Yields the article's revisions one API page at a time, as lists of
+    dicts with "timestamp", "revid" and "content" keys from older to newer
+    """
+    base_url = f"https://{lang}.wikipedia.org/w/api.php"
+
+    session = make_session()
+
+    params = {
+        'action': 'query',
+        'format': 'json',
+        'prop': 'revisions',
+        'titles': article_title,
+        # Avoid asking for unnecessary properties
+        'rvprop': 'ids|timestamp|content',
+        # Only the main slot's content, the legacy slot-less format is deprecated
+        'rvslots': 'main',
+        'rvlimit': 1000,
+        # Quite contradictory, but older to newer order
+        'rvdir': 'newer',
+        'rvsection': 0
+    }
+
+    while True:
+        response = session.get(base_url, params=params)
+        data = response.json()
+
+        # Process the response to get revision IDs
+        page = next(iter(data['query']['pages'].values()))
+        revisions = page["revisions"]
+
+        revisions_data = []
+        for revision in revisions:
+            content = revision.get('slots', {}).get('main', {})
+            if all(key in revision for key in ['revid', 'timestamp']) and '*' in content:
+                # A very small number of revisions lack contents,
+                # avoid erroring out.
+                # Convert the API's custom timestamp to a unix one for better portability.
+                # It's always ISO 8601 in UTC ("2001-01-15T14:56:00Z"), which fromisoformat
+                # parses much faster than strptime once the 'Z' is spelled as an offset
+                dt_object = datetime.fromisoformat(revision['timestamp'].replace('Z', '+00:00'))
+                revisions_data.append({
+                    'timestamp': int(dt_object.timestamp()),
+                    'revid': revision['revid'],
+                    'content': content['*']
+                })
+
+        yield revisions_data
+
+        if 'continue' in data:
+            params['rvcontinue'] = data['continue']['rvcontinue']
+        else:
+            break
 
 
 def download_revisions(lang, article_title):
     revisions_written = 0
-    with open(f'{article_title}_{lang}.json', 'w') as f:
-        f.write("[\n")  # JSON head
-
-        base_url = f"https://{lang}.wikipedia.org/w/api.php"
-
-        headers = {
-            "User-Agent": USER_AGENT
-        }
-
-        params = {
-            'action': 'query',
-            'format': 'json',
-            'prop': 'revisions',
-            'titles': article_title,
-            # Avoid asking for unnecessary properties
-            'rvprop': 'timestamp|content',
-            'rvlimit': 1000,
-            'offset': revisions_written,
-            # Quite contradictory, but older to newer order
-            'rvdir': 'newer',
-            'rvsection': 0
-        }
-
-        while True:
-            response = requests.get(base_url, headers=headers, params=params)
-            data = response.json()
-
-            # Process the response to get revision IDs
-            page = next(iter(data['query']['pages'].values()))
-            revisions = page["revisions"]
-
-            revisions_data = []
-            for revision in revisions:
-                if all(key in revision for key in ['timestamp', '*']):
-                    # A very small number of revisions lack contents,
-                    # avoid erroring out
-                    revisions_data.append({
-                        'timestamp': revision['timestamp'],
-                        'content': revision['*']
-                    })
-
+    # The raw revisions are written as JSON Lines, so they can be read back one
+    # revision at a time, and a partially written file is still readable up to its
+    # last complete line (see read_revision_lines)
+    with open(f'{article_title}_{lang}.jsonl', 'w', encoding='utf-8') as f:
+        for revisions_data in fetch_revisions(lang, article_title):
+            write_revision_lines(f, revisions_data)
             revisions_written += len(revisions_data)
-
-            write_revisions(f, revisions_data)
-
             print(f"\rWritten {revisions_written} revisions...", end='')
-            if 'continue' in data:
-                params['rvcontinue'] = data['continue']['rvcontinue']
-                f.write(",\n")
-            else:
-                f.write("\n]")  # JSON's tail
-                print("Finished!")
-                break
 
-
-def process_chunk(chunk):
-    return [(entry["timestamp"], entry["content"]) for entry in sorted(chunk, key=lambda x: x["timestamp"])]
+        print("Finished!")
 
 
 def clean_revision(timestamp_content):
     timestamp, content = timestamp_content
-    return timestamp, clean_doc(mwparserfromhell.parse(content).strip_code())
-
-
-def clean_revisions_in_batches(file_path):
-    with open(file_path, 'r', encoding='utf-8') as file:
-        json_parser = ijson.items(file, 'item')
-        chunk_size = 100
-        i = 1
-
-        clean_revisions = []
-        with ProcessPoolExecutor(max_workers=N_WORKERS) as executor:
-            for chunk in iter(lambda: list(itertools.islice(json_parser, chunk_size)), []):
-                # Process each chunk concurrently
-                revisions = process_chunk(chunk)
-                clean_results = list(executor.map(clean_revision, revisions))
-                clean_revisions.extend(clean_results)
-                print(f"\rProcessed {chunk_size * i} revisions", end="")
-                i += 1
-
-    return clean_revisions
+    # Same (timestamp, content, used_fallback) result as clean_revision_from_api
+    return timestamp, clean_doc(mwparserfromhell.parse(content).strip_code()), False
+
+
+def fetch_revision_text(lang, revid):
+    """
+    Returns the plain text of a revision's lead section as rendered by the
+    parse API, or None if it couldn't be retrieved
+    """
+    global _parse_session
+    if _parse_session is None:
+        _parse_session = make_session()
+
+    params = {
+        'action': 'parse',
+        'format': 'json',
+        'oldid': revid,
+        'prop': 'text',
+        # The same section the revisions are downloaded with
+        'section': 0,
+        'disableeditsection': 1,
+        'disablelimitreport': 1
+    }
+
+    try:
+        response = _parse_session.get(f"https://{lang}.wikipedia.org/w/api.php", params=params)
+        html = response.json()['parse']['text']['*']
+        tree = lxml.html.fromstring(html)
+    except (requests.RequestException, ValueError, KeyError, lxml.etree.LxmlError):
+        return None
+
+    # The parse API returns the rendered page, so everything that isn't prose has
+    # to be dropped here to match what strip_code() and clean_doc() would leave
+    for element in tree.xpath(_NON_PROSE_XPATH):
+        element.drop_tree()
+
+    return tree.text_content()
+
+
+def clean_revision_from_api(lang, timestamp_content_revid):
+    """
+    Alternative to clean_revision that lets the parse API render the revision
+    instead of parsing its Wikitext locally, which is much cheaper in CPU but
+    costs an extra API request per revision. Falls back to mwparserfromhell
+    if lxml isn't installed or the request fails, which is reported by the
+    returned (timestamp, content, used_fallback) tuple
+    """
+    timestamp, content, revid = timestamp_content_revid
+
+    text = fetch_revision_text(lang, revid) if lxml is not None else None
+    used_fallback = text is None
+    if used_fallback:
+        text = mwparserfromhell.parse(content).strip_code()
+
+    return timestamp, clean_doc(text), used_fallback
+
+
+def map_chunksize(revisions):
+    # Send revisions to the workers in batches rather than pickling them one by one
+    return max(1, len(revisions) // (N_WORKERS * N_TASKS_PER_WORKER))
+
+
+def clean_revisions_cached(executor, cleaner, revisions, clean_cache):
+    """
+    Cleans a chunk of (timestamp, content, ...) revision tuples with the given
+    cleaner in the worker processes, only sending them the revisions whose content
+    isn't in clean_cache (an OrderedDict of content digest -> (cleaned text,
+    used_fallback), kept in least to most recently used order).
+
+    Returns the cleaned (timestamp, content) tuples in the same order, along with
+    how many of them had to fall back to mwparserfromhell
+    """
+    digests = [hashlib.blake2b(revision[1].encode('utf-8'), digest_size=16).digest() for revision in revisions]
+
+    # Revisions repeated within the chunk are also only cleaned once
+    pending = dict()
+    for digest, revision in zip(digests, revisions):
+        if digest in clean_cache:
+            clean_cache.move_to_end(digest)
+        elif digest not in pending:
+            pending[digest] = revision
+
+    pending_revisions = list(pending.values())
+    pending_results = executor.map(cleaner, pending_revisions, chunksize=map_chunksize(pending_revisions))
+    for digest, (_, clean_content, used_fallback) in zip(pending, pending_results):
+        clean_cache[digest] = (clean_content, used_fallback)
+
+    clean_results = [(revision[0], clean_cache[digest][0]) for digest, revision in zip(digests, revisions)]
+    n_fallbacks = sum(clean_cache[digest][1] for digest in digests)
+
+    # Only evict once the chunk is done, as it may need more than CLEAN_CACHE_SIZE entries
+    while len(clean_cache) > CLEAN_CACHE_SIZE:
+        clean_cache.popitem(last=False)
+
+    return clean_results, n_fallbacks
+
+
+def write_clean_revisions(f, clean_results, first_entry):
+    """
+    Streams a chunk of cleaned (timestamp, content) tuples into the output
+    JSON list, returning whether the next entry will still be the first one
+    """
+    clean_entries = ({'timestamp': timestamp, 'content': content} for timestamp, content in clean_results)
+    return write_revisions(f, clean_entries, first_entry)
+
+
+def clean_revisions_in_batches(file_path, out_path):
+    """
+    Cleans a JSON Lines revisions file previously written by download_revisions
+    """
+    with open(file_path, 'rb') as file, open(out_path, 'w', encoding='utf-8') as out:
+        # Read one revision at a time, the file may be too big to fit in memory
+        revisions_iter = read_revision_lines(file)
+        revisions_cleaned = 0
+
+        out.write("[\n")  # JSON head
+        first_entry = True
+        clean_cache = collections.OrderedDict()
+        with ProcessPoolExecutor(max_workers=N_WORKERS, mp_context=_WORKERS_CONTEXT) as executor:
+            for chunk in iter(lambda: list(itertools.islice(revisions_iter, CHUNK_SIZE)), []):
+                # Process each chunk concurrently, writing it right away so only
+                # a chunk's worth of revisions is kept in memory. The file is already
+                # ordered from older to newer revisions, so there's no need to sort it
+                revisions = [(entry["timestamp"], entry["content"]) for entry in chunk]
+                clean_results, _ = clean_revisions_cached(executor, clean_revision, revisions, clean_cache)
+                first_entry = write_clean_revisions(out, clean_results, first_entry)
+                revisions_cleaned += len(revisions)
+                print(f"\rProcessed {revisions_cleaned} revisions", end="")
+
+        out.write("\n]")  # JSON's tail
+
+
+def download_and_clean_revisions(lang, article_title, out_path, keep_raw=False, use_parse_api=False):
+    """
+    Downloads and cleans the article's revisions at the same time: a thread
+    fetches API pages while the already downloaded ones are being cleaned by
+    the worker processes, streaming the results to out_path.
+
+    The raw revisions are only written (to '{article_title}_{lang}.jsonl') if
+    keep_raw is set. If use_parse_api is set, revisions are rendered by the
+    parse API instead of being parsed locally (see clean_revision_from_api)
+    """
+    raw_path = f'{article_title}_{lang}.jsonl'
+    with open(out_path, 'w', encoding='utf-8') as out, \
+            (open(raw_path, 'w', encoding='utf-8') if keep_raw else contextlib.nullcontext()) as raw:
+        out.write("[\n")  # JSON head
+        first_entry = True
+
+        revisions_cleaned = 0
+        revisions_fallen_back = 0
+        clean_cache = collections.OrderedDict()
+        with ProcessPoolExecutor(max_workers=N_WORKERS, mp_context=_WORKERS_CONTEXT) as executor:
+            # Only up to MAX_PENDING_PAGES pages are downloaded ahead, so that a slow
+            # cleaning step doesn't pile up downloaded pages in memory
+            for revisions_data in prefetch(fetch_revisions(lang, article_title)):
+                if raw is not None:
+                    write_revision_lines(raw, revisions_data)
+
+                if use_parse_api:
+                    revisions = [(entry["timestamp"], entry["content"], entry["revid"]) for entry in revisions_data]
+                    clean_results, n_fallbacks = clean_revisions_cached(
+                        executor, functools.partial(clean_revision_from_api, lang), revisions, clean_cache)
+                else:
+                    revisions = [(entry["timestamp"], entry["content"]) for entry in revisions_data]
+                    clean_results, n_fallbacks = clean_revisions_cached(executor, clean_revision, revisions, clean_cache)
+                first_entry = write_clean_revisions(out, clean_results, first_entry)
+                revisions_cleaned += len(revisions)
+                revisions_fallen_back += n_fallbacks
+                print(f"\rProcessed {revisions_cleaned} revisions", end="")
+
+        out.write("\n]")  # JSON's tail
+        print("Finished!")
+        if revisions_fallen_back:
+            # Their text comes from a different extractor, so it may not be consistent with the rest
+            print(f"{revisions_fallen_back} revisions couldn't be rendered by the parse API "
+                  f"and were parsed with mwparserfromhell instead")
 
 
 if __name__ == "__main__":
@@ -170,16 +434,25 @@ if __name__ == "__main__":
 
     # Language code for the article
     lang = 'en'
-    download_revisions(lang, title)
 
-    # Parse and clean the downloaded revisions in batches, using multiprocessing.
-    # We do this after downloading because parsing Wikitext and then cleaning the
-    # text is very costly, so doing it inbetween API requests would be extremely slow.
+    # Whether to also write the raw (unparsed) revisions to '{title}_{lang}.jsonl'
+    keep_raw = False
+
+    # Whether to let the parse API render each revision instead of parsing its
+    # Wikitext locally. Much lighter on the CPU, but it sends an extra API request
+    # per revision (N_WORKERS at a time), so please use it sparingly
+    use_parse_api = False
+
+    # Download the revisions while parsing and cleaning the already downloaded
+    # ones in batches, using multiprocessing. Parsing Wikitext and then cleaning
+    # the text is very costly, so the workers do it while the API requests are
+    # in flight instead of inbetween them.
+    #
+    # Additionally, the article may be extremely big (Donald Trump's entire history
+    # is 11GiB), so keeping it in memory is not an option. Only a few pages of
+    # revisions are kept at a time, and the cleaned revisions are written as soon
+    # as each page is processed.
     #
-    # Additionally, we need to be careful when reading the revisions file. Since
-    # the article may be extremely big (Donald Trump's entire history is 11GiB),
-    # reading it directly will fill the memory. Due to this, we use ijson to
-    # iteratively read the JSON file we previously wrote.
-    clean_revisions = clean_revisions_in_batches(f"{title}_{lang}.json")
-    with open(f"{title}_{lang}_clean.json", "w") as f:
-        json.dump(clean_revisions, f, ensure_ascii=False, indent=4)
+    # If you already have a raw revisions file, you can clean it with
+    # clean_revisions_in_batches(f"{title}_{lang}.jsonl", f"{title}_{lang}_clean.json")
+    download_and_clean_revisions(lang, title, f"{title}_{lang}_clean.json", keep_raw, use_parse_api)
@@ -0,0 +1,57 @@
+"""
+Helpers shared by the scripts that download revisions through the Wikipedia API:
+a retrying HTTP session and a background iterator, so that the next page of
+revisions is downloaded while the current one is being processed
+"""
+
+import queue
+import threading
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+
+USER_AGENT = "My Wikipedia API project (change me!)"
+
+# How many downloaded API pages (of up to 1000 revisions) may wait to be processed
+MAX_PENDING_PAGES = 4
+
+
+def make_session():
+    # A single session keeps the connection alive across the (many) paginated requests,
+    # and retries rate limited or failed requests instead of aborting a long download
+    session = requests.Session()
+    session.headers.update({"User-Agent": USER_AGENT})
+    session.mount("https://", HTTPAdapter(max_retries=Retry(total=5, backoff_factor=0.3, status_forcelist=[429, 503])))
+    return session
+
+
+def prefetch(iterable, max_pending=MAX_PENDING_PAGES):
+    """
+    Iterates over iterable in a background thread, up to max_pending items ahead,
+    so that e.g. the next API request is already in flight while the current page
+    of revisions is being processed
+    """
+    pending = queue.Queue(maxsize=max_pending)
+
+    def produce():
+        # Errors are handed over to the consumer so that they aren't silently
+        # lost with the thread
+        try:
+            for item in iterable:
+                pending.put(item)
+        except Exception as e:
+            pending.put(e)
+        else:
+            pending.put(None)
+
+    threading.Thread(target=produce, daemon=True).start()
+
+    while True:
+        item = pending.get()
+        if item is None:
+            return
+        if isinstance(item, Exception):
+            raise item
+        yield item